@@ -2,6 +2,7 @@ import numpy as np
 import open3d as o3d
 import copy
 import cv2
+import functools
 from contextlib import contextmanager
 import time
 
@@ -189,14 +190,22 @@ def project_2d_points_to_3d(points, depth, camera_matrix, distCoeffs = None):
 
 
 def get_mesh_from_depth_map(depth_map, cam_mat, color_frame = None, inp_mesh = None, remove_edges = False):
-    points, height, width = create_point_cloud_from_depth(depth_map, cam_mat, True)
+    vertex_buffer = None
+    if inp_mesh is not None:
+        # Write the new vertices straight into the existing mesh instead of allocating a new point array every frame
+        vertex_buffer = np.asarray(inp_mesh.vertices)
+    points, height, width = create_point_cloud_from_depth(depth_map, cam_mat, True, vertex_buffer)
 
     # Create mesh from point cloud
     mesh, used_indices = create_mesh_from_point_cloud(points, height, width, color_frame, inp_mesh, remove_edges)
     return mesh, used_indices
 
-def create_point_cloud_from_depth(depth_image, intrinsics, of_by_one = False):
-    height, width = depth_image.shape
+@functools.lru_cache(maxsize=4)
+def _pixel_rays(height, width, fx, fy, cx, cy, of_by_one):
+    """
+    Returns a (height*width, 3) array of [(x - cx)/fx, (y - cy)/fy, 1] for every pixel.
+    The rays only depend on the camera so they are cached, a point is then simply ray * depth.
+    """
     x, y = np.meshgrid(np.arange(width), np.arange(height))
 
     #Here we fix a of by one error caused by the fact that this function fills in the area betwen each vertex
@@ -206,13 +215,19 @@ def create_point_cloud_from_depth(depth_image, intrinsics, of_by_one = False):
         x *= (width+1)/width
         y *= (height+1)/height
 
+    rays = np.empty((height*width, 3), dtype=np.float32)
+    rays[:, 0] = ((x - cx) / fx).reshape(-1)  # (x - cx) / fx
+    rays[:, 1] = ((y - cy) / fy).reshape(-1)  # (y - cy) / fy
+    rays[:, 2] = 1.0
+    rays.setflags(write=False)
+    return rays
 
-    z = depth_image  # Assuming depth is in millimeters
-    x3d = (x - intrinsics[0][2]) * z / intrinsics[0][0]  # (x - cx) * z / fx
-    y3d = (y - intrinsics[1][2]) * z / intrinsics[1][1]  # (y - cy) * z / fy
-
+def create_point_cloud_from_depth(depth_image, intrinsics, of_by_one = False, out = None):
+    height, width = depth_image.shape
+    rays = _pixel_rays(height, width, float(intrinsics[0][0]), float(intrinsics[1][1]), float(intrinsics[0][2]), float(intrinsics[1][2]), of_by_one)
 
-    points = np.stack((x3d, y3d, z), axis=-1).reshape(-1, 3)
+    z = depth_image.reshape(-1, 1)  # Assuming depth is in millimeters
+    points = np.multiply(rays, z, out=out)
 
 
     return points, height, width
@@ -267,6 +282,30 @@ def perspective_aware_down_sample(pcd, voxel_size_norm):
     return pcd_down_warped
 
 
+@functools.lru_cache(maxsize=4)
+def _grid_triangles(height, width):
+    """
+    Returns the (read only, int32) triangles connecting a height x width grid of vertices.
+    For each grid cell at (i, j) with i in [0, height-2] and j in [0, width-2],
+    we define two triangles:
+       tri1: (i, j), (i+1, j), (i+1, j+1)
+       tri2: (i, j), (i+1, j+1), (i, j+1)
+    """
+    grid_i, grid_j = np.meshgrid(np.arange(height - 1), np.arange(width - 1), indexing='ij')
+    grid_i = grid_i.ravel()  # Flatten to 1D arrays (num_cells,)
+    grid_j = grid_j.ravel()
+
+    idx1 = grid_i * width + grid_j
+    idx2 = (grid_i + 1) * width + grid_j
+    idx3 = (grid_i + 1) * width + (grid_j + 1)
+    idx4 = grid_i * width + (grid_j + 1)
+
+    tri1 = np.stack([idx1, idx2, idx3], axis=1)
+    tri2 = np.stack([idx1, idx3, idx4], axis=1)
+    triangles_all = np.vstack([tri1, tri2]).astype(np.int32) # Open3D stores triangles as int32
+    triangles_all.setflags(write=False)
+    return triangles_all
+
 zero_identity_matrix = np.identity(4)
 def create_mesh_from_point_cloud(points, height, width,
                                  image_frame=None,
@@ -298,10 +337,10 @@ def create_mesh_from_point_cloud(points, height, width,
     
     used_indices = []
     
-    # Optionally, get vertex colors.
+    # Optionally, get vertex colors. (they are scaled to 0-1 straight into the mesh when there is one)
     colors = None
     if image_frame is not None:
-        colors = np.array(image_frame).reshape(-1, 3) / 255.0
+        colors = np.asarray(image_frame).reshape(-1, 3)
     
     # If no mesh exists or if we need to remove edges, compute the triangles.
     if inp_mesh is None or remove_edges:
@@ -312,37 +351,23 @@ def create_mesh_from_point_cloud(points, height, width,
             mesh.transform(zero_identity_matrix)
         
         # --- Generate candidate triangles via the grid layout ---
-        # For each grid cell at (i, j) with i in [0, height-2] and j in [0, width-2],
-        # we define two triangles:
-        #    tri1: (i, j), (i+1, j), (i+1, j+1)
-        #    tri2: (i, j), (i+1, j+1), (i, j+1)
-        grid_i, grid_j = np.meshgrid(np.arange(height - 1), np.arange(width - 1), indexing='ij')
-        grid_i = grid_i.ravel()  # Flatten to 1D arrays (num_cells,)
-        grid_j = grid_j.ravel()
-    
-        idx1 = grid_i * width + grid_j
-        idx2 = (grid_i + 1) * width + grid_j
-        idx3 = (grid_i + 1) * width + (grid_j + 1)
-        idx4 = grid_i * width + (grid_j + 1)
-    
-        tri1 = np.stack([idx1, idx2, idx3], axis=1)
-        tri2 = np.stack([idx1, idx3, idx4], axis=1)
-        triangles_all = np.vstack([tri1, tri2])
+        triangles_all = _grid_triangles(height, width)
         
         if inp_mesh is None:
             mesh.triangles = o3d.utility.Vector3iVector(triangles_all)
             mesh.vertices = o3d.utility.Vector3dVector(vertices)
             if colors is not None:
-                mesh.vertex_colors = o3d.utility.Vector3dVector(colors)
+                mesh.vertex_colors = o3d.utility.Vector3dVector(colors / 255.0)
         
         ref_to_all_tri = np.asarray(mesh.triangles)
         ref_to_all_vert = np.asarray(mesh.vertices)
         ref_to_all_col = np.asarray(mesh.vertex_colors)
         if inp_mesh is not None:
             ref_to_all_tri[:] = triangles_all[:]
-            ref_to_all_vert[:] = vertices[:]
+            if not np.shares_memory(ref_to_all_vert, vertices):
+                ref_to_all_vert[:] = vertices[:]
             if colors is not None:
-                ref_to_all_col[:] = colors[:]
+                np.divide(colors, 255.0, out=ref_to_all_col)
         
         # --- Filter triangles based on the triangle angle relative to the camera ---
         if remove_edges:
@@ -378,10 +403,11 @@ def create_mesh_from_point_cloud(points, height, width,
     else:
         mesh = inp_mesh
         ref_to_all_vert = np.asarray(mesh.vertices)
-        ref_to_all_vert[:] = vertices[:]
+        if not np.shares_memory(ref_to_all_vert, vertices):
+            ref_to_all_vert[:] = vertices[:]
         if colors is not None:
             ref_to_all_col = np.asarray(mesh.vertex_colors)
-            ref_to_all_col[:] = colors[:]
+            np.divide(colors, 255.0, out=ref_to_all_col)
     
     
     return mesh, used_indices
@@ -391,8 +417,69 @@ v_h = None
 use_ofscreen = True
 v_w = None
 rend = None
-def render(objects, cam_mat, depth = False, w = None, h = None, extrinsic_matric = np.eye(4), bg_color = np.array([0, 0, 0])):
-    global vis, v_h, v_w, use_ofscreen, rend
+def _setup_visualizer(objects, cam_mat, w, h, extrinsic_matric, bg_color):
+    """
+    Uploads the objects to the (hidden) Visualizer window and points the camera using cam_mat and extrinsic_matric.
+    Returns the view control and camera parameters so that the camera can be moved without re uploading the objects.
+    """
+    global vis
+
+    if vis is None:
+        vis = o3d.visualization.Visualizer()
+        vis.create_window(width=int(w), height=int(h), visible=False) #works for me with False, on some systems needs to be true
+    vis.clear_geometries()
+
+    rend_opt = vis.get_render_option()
+    rend_opt.background_color = bg_color
+    rend_opt.point_size = 1.0
+    
+    ctr = vis.get_view_control()
+    ctr.set_lookat([0, 0, 1])
+    ctr.set_up([0, -1, 0])
+    ctr.set_front([0, 0, -1])
+    ctr.set_zoom(1)
+    
+
+
+    params = ctr.convert_to_pinhole_camera_parameters()
+
+    #print("pos", params.extrinsic, params.intrinsic)
+    params.extrinsic = extrinsic_matric
+    intrinsic = o3d.camera.PinholeCameraIntrinsic()
+    #There is a bug in open3d where focaly is not used
+    #https://github.com/isl-org/Open3D/issues/1343
+
+    #Bug workaround where we scale the geometry insted of the viewport
+    scale_up_factor = cam_mat[1][1]/cam_mat[0][0]
+    
+    for obj in objects:
+        obj2 = copy.deepcopy(obj)
+        if hasattr(obj2, 'points'):
+            np.asarray(obj2.points)[:,1] *= scale_up_factor
+        else:
+            np.asarray(obj2.vertices)[:,1] *= scale_up_factor
+
+        vis.add_geometry(obj2)
+        vis.update_geometry(obj2)
+
+
+    intrinsic.intrinsic_matrix = np.array([
+        [999999, 0.          , cam_mat[0][2]     ],#99999 should be focalx This is reversed from a normal cam_matrix but this is a hack and it works.. dont ask se above bug
+        [  0.  , cam_mat[0][0]      , cam_mat[1][2]     ],
+        [  0.  , 0.          , 1.        ]])
+    params.intrinsic = intrinsic
+    ctr.convert_from_pinhole_camera_parameters(params, allow_arbitrary=True)
+    vis.update_renderer()
+
+
+    rend_opt.light_on = False
+    vis.poll_events()
+    vis.update_renderer()
+
+    return ctr, params
+
+def _resize_viewport(cam_mat, w, h):
+    global vis, v_h, v_w, rend
 
     if w is None:
         w = cam_mat[0][2]*2
@@ -404,6 +491,12 @@ def render(objects, cam_mat, depth = False, w = None, h = None, extrinsic_matric
         rend = None
         v_h = h
         v_w = w
+    return w, h
+
+def render(objects, cam_mat, depth = False, w = None, h = None, extrinsic_matric = np.eye(4), bg_color = np.array([0, 0, 0])):
+    global vis, v_h, v_w, use_ofscreen, rend
+
+    w, h = _resize_viewport(cam_mat, w, h)
 
 
     #We set use_ofscreen to False to disable OffscreenRenderer cause it is bugged and is missing required API's
@@ -419,57 +512,7 @@ def render(objects, cam_mat, depth = False, w = None, h = None, extrinsic_matric
 
     if rend is None:
 
-        if vis is None:
-            vis = o3d.visualization.Visualizer()
-            vis.create_window(width=int(w), height=int(h), visible=False) #works for me with False, on some systems needs to be true
-        vis.clear_geometries()
-
-        rend_opt = vis.get_render_option()
-        rend_opt.background_color = bg_color
-        rend_opt.point_size = 1.0
-        
-        ctr = vis.get_view_control()
-        ctr.set_lookat([0, 0, 1])
-        ctr.set_up([0, -1, 0])
-        ctr.set_front([0, 0, -1])
-        ctr.set_zoom(1)
-        
-
-
-        params = ctr.convert_to_pinhole_camera_parameters()
-
-        #print("pos", params.extrinsic, params.intrinsic)
-        params.extrinsic = extrinsic_matric
-        intrinsic = o3d.camera.PinholeCameraIntrinsic()
-        #There is a bug in open3d where focaly is not used
-        #https://github.com/isl-org/Open3D/issues/1343
-
-        #Bug workaround where we scale the geometry insted of the viewport
-        scale_up_factor = cam_mat[1][1]/cam_mat[0][0]
-        
-        for obj in objects:
-            obj2 = copy.deepcopy(obj)
-            if hasattr(obj2, 'points'):
-                np.asarray(obj2.points)[:,1] *= scale_up_factor
-            else:
-                np.asarray(obj2.vertices)[:,1] *= scale_up_factor
-
-            vis.add_geometry(obj2)
-            vis.update_geometry(obj2)
-
-
-        intrinsic.intrinsic_matrix = np.array([
-            [999999, 0.          , cam_mat[0][2]     ],#99999 should be focalx This is reversed from a normal cam_matrix but this is a hack and it works.. dont ask se above bug
-            [  0.  , cam_mat[0][0]      , cam_mat[1][2]     ],
-            [  0.  , 0.          , 1.        ]])
-        params.intrinsic = intrinsic
-        ctr.convert_from_pinhole_camera_parameters(params, allow_arbitrary=True)
-        vis.update_renderer()
-
-
-        rend_opt.light_on = False
-        vis.poll_events()
-        vis.update_renderer()
+        _setup_visualizer(objects, cam_mat, w, h, extrinsic_matric, bg_color)
 
 
         #For some reason using capture_depth_float_buffer is very slow taking about a tenth of a second while capture_screen_float_buffer is like 100 times faster
@@ -505,6 +548,129 @@ def render(objects, cam_mat, depth = False, w = None, h = None, extrinsic_matric
 
     return np.asarray(image)
 
+def _eye_extrinsics(baseline):
+    """
+    Returns the (left, right) extrinsic matrices for two eyes placed baseline meters apart on the x-axis.
+    """
+    # Moving the camera half the baseline to the left is the same as moving the scene half the baseline to the right
+    left_extrinsic = np.eye(4)
+    left_extrinsic[0][3] = baseline/2
+    right_extrinsic = np.eye(4)
+    right_extrinsic[0][3] = -baseline/2
+    return left_extrinsic, right_extrinsic
+
+def render_stereo(objects, cam_mat, baseline, depth = False, w = None, h = None, bg_color = np.array([0, 0, 0])):
+    """
+    Renders the objects from a left and a right eye placed baseline meters apart on the x-axis.
+    The objects are only uploaded to the renderer once, the camera is then moved between the two eyes.
+    
+    Returns:
+      (left_image, right_image) or (left_image, right_image, left_depth) if depth is True.
+    """
+    w, h = _resize_viewport(cam_mat, w, h)
+
+    left_extrinsic, right_extrinsic = _eye_extrinsics(baseline)
+
+    ctr, params = _setup_visualizer(objects, cam_mat, w, h, left_extrinsic, bg_color)
+    left_image = np.asarray(vis.capture_screen_float_buffer(do_render=True))
+    if depth:
+        left_depth = np.asarray(vis.capture_depth_float_buffer(do_render=False))
+
+    params.extrinsic = right_extrinsic
+    ctr.convert_from_pinhole_camera_parameters(params, allow_arbitrary=True)
+    vis.poll_events()
+    vis.update_renderer()
+    right_image = np.asarray(vis.capture_screen_float_buffer(do_render=True))
+
+    if depth:
+        return left_image, right_image, left_depth
+    return left_image, right_image
+
+cuda_rast_ctx = None
+cuda_triangles_key = None
+cuda_triangles = None
+def render_stereo_cuda(objects, cam_mat, baseline, depth = False, w = None, h = None, bg_color = np.array([0, 0, 0]), z_near = 0.05, z_far = 1000.0, triangles_changed = False):
+    """
+    Same as render_stereo but rasterizes the meshes on the GPU with nvdiffrast (requires torch and nvdiffrast)
+    instead of going through the Open3D Visualizer. Both eyes are rasterized in one batched call with a plain
+    pinhole projection so the Open3D focal length workaround is not needed. Only triangle meshes are supported.
+    The triangle index buffer is kept on the GPU between calls for the same meshes, set triangles_changed
+    if the triangles have been modified (ie. when edges are removed) so that it is uploaded again.
+    
+    Returns:
+      (left_image, right_image) or (left_image, right_image, left_depth) if depth is True.
+    """
+    global cuda_rast_ctx, cuda_triangles_key, cuda_triangles
+    import torch
+    import nvdiffrast.torch as dr
+
+    if w is None:
+        w = cam_mat[0][2]*2
+        h = cam_mat[1][2]*2
+    w, h = int(w), int(h)
+
+    if cuda_rast_ctx is None:
+        cuda_rast_ctx = dr.RasterizeCudaContext()
+
+    for obj in objects:
+        if not hasattr(obj, 'triangles'):
+            raise ValueError("render_stereo_cuda can only render triangle meshes")
+
+    # Only the vertices and colors change every frame, the triangles are reused from the last call if the meshes are the same
+    triangles_key = tuple((id(obj), len(obj.triangles)) for obj in objects)
+    if triangles_changed or triangles_key != cuda_triangles_key:
+        if len(objects) == 1:
+            triangles = np.asarray(objects[0].triangles)
+        else:
+            # Merge all meshes in to one index buffer
+            triangles, vertex_offset = [], 0
+            for obj in objects:
+                triangles.append(np.asarray(obj.triangles) + vertex_offset)
+                vertex_offset += len(obj.vertices)
+            triangles = np.concatenate(triangles)
+        cuda_triangles = torch.from_numpy(triangles).to('cuda', torch.int32)
+        cuda_triangles_key = triangles_key
+    triangles = cuda_triangles
+
+    if len(objects) == 1:
+        vertices = torch.from_numpy(np.asarray(objects[0].vertices)).to('cuda', torch.float32)
+        colors = torch.from_numpy(np.asarray(objects[0].vertex_colors)).to('cuda', torch.float32)
+    else:
+        vertices = torch.cat([torch.from_numpy(np.asarray(obj.vertices)).to('cuda', torch.float32) for obj in objects])
+        colors = torch.cat([torch.from_numpy(np.asarray(obj.vertex_colors)).to('cuda', torch.float32) for obj in objects])
+
+    # Pinhole projection to clip space, image rows go downwards which is also the order nvdiffrast outputs rows in
+    fx, fy = cam_mat[0][0], cam_mat[1][1]
+    cx, cy = cam_mat[0][2], cam_mat[1][2]
+    projection = np.array([
+        [2*fx/w, 0.    , 2*cx/w - 1                     , 0.                                 ],
+        [0.    , 2*fy/h, 2*cy/h - 1                     , 0.                                 ],
+        [0.    , 0.    , (z_far+z_near)/(z_far-z_near)  , -2*z_far*z_near/(z_far-z_near)     ],
+        [0.    , 0.    , 1.                             , 0.                                 ]])
+
+    eye_matrices = [projection @ extrinsic for extrinsic in _eye_extrinsics(baseline)]
+    mvp = torch.from_numpy(np.stack(eye_matrices)).to('cuda', torch.float32) # (2, 4, 4)
+
+    vertices_hom = torch.cat([vertices, torch.ones_like(vertices[:, :1])], dim=1)
+    pos_clip = torch.matmul(vertices_hom, mvp.transpose(1, 2)).contiguous() # (2, N, 4)
+
+    with torch.no_grad():
+        rast, _ = dr.rasterize(cuda_rast_ctx, pos_clip, triangles, resolution=[h, w])
+        covered = rast[..., 3:] > 0
+
+        images, _ = dr.interpolate(colors[None], rast, triangles)
+        background = torch.tensor(np.asarray(bg_color), dtype=torch.float32, device='cuda')
+        images = torch.where(covered, images, background)
+
+        left_image, right_image = images.cpu().numpy()
+        if depth:
+            # Camera z is the same for both eyes as they are only shifted along x, unrendered pixels get zero depth like in render()
+            left_depth, _ = dr.interpolate(vertices[:, 2:3].contiguous()[None], rast[:1], triangles)
+            left_depth = torch.where(covered[:1], left_depth, 0.0)[0, ..., 0].cpu().numpy()
+            return left_image, right_image, left_depth
+
+    return left_image, right_image
+
 def cam_look_at(cam_pos, target, up = np.array([0.0, 1.0, 0.0])):
 
     f = target - cam_pos
@@ -2,10 +2,13 @@ import argparse
 import cv2
 import numpy as np
 import os
-import copy
 import sys
 import time
 import json
+import functools
+import queue
+import threading
+import concurrent.futures
 
 import open3d as o3d
 import depth_map_tools
@@ -21,37 +24,33 @@ def timer(name = 'not named'):
 
 np.set_printoptions(suppress=True, precision=4)
 
-def convert_to_equirectangular(image, input_fov=100):
+# cv2.remap releases the GIL so the 2-3 equirectangular conversions per frame can run in parallel
+_remap_pool = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+
+@functools.lru_cache(maxsize=4)
+def _build_equirect_maps(H, W, input_fov):
     """
-    Maps an input rectilinear image rendered at a limited FOV (e.g., 100°)
-    into a 180° equirectangular image while keeping the output size the same as the input.
-    The valid image (representing the central 100°) is centered,
-    with black padding on the sides and top/bottom.
+    Builds the cv2.remap lookup tables used by convert_to_equirectangular.
+    The maps only depend on the image size and fov so they are cached and reused across frames and eyes.
     
-    Parameters:
-      image: Input image (H x W x 3, np.uint8)
-      input_fov: Field of view (in degrees) of the input image. Default is 100.
-      
     Returns:
-      A new image (np.uint8) of the same shape as input, representing a 180° equirectangular projection.
+      (map1, map2) in the fixed point CV_16SC2 format that cv2.remap consumes natively.
     """
-    # Get image dimensions.
-    H, W = image.shape[:2]
     # Center coordinates of the input image.
     cx = (W - 1) / 2.0
     cy = (H - 1) / 2.0
     
     # For the output, we want to cover a horizontal range of [-90, 90] degrees.
-    # Create a grid of pixel coordinates for the output image.
+    # The mapping is separable, x only depends on the output column and y only on the output row,
+    # so everything is computed on 1D coordinates and only broadcast to the full image at the end.
     x_coords = np.linspace(0, W - 1, W)
     y_coords = np.linspace(0, H - 1, H)
-    grid_x, grid_y = np.meshgrid(x_coords, y_coords)
     
     # Map output pixel positions to spherical angles.
     # Horizontal: x -> theta in [-pi/2, pi/2]
-    theta = (grid_x - cx) / cx * (np.pi / 2)
+    theta = (x_coords - cx) / cx * (np.pi / 2)
     # Vertical: y -> phi in [-pi/2, pi/2]
-    phi = (grid_y - cy) / cy * (np.pi / 2)
+    phi = (y_coords - cy) / cy * (np.pi / 2)
     
     # The input image covers only a limited field of view.
     half_input_fov = np.radians(input_fov / 2.0)  # e.g. 50° in radians.
@@ -62,28 +61,254 @@ def convert_to_equirectangular(image, input_fov=100):
     f_y = cy / np.tan(half_input_fov)
     
     # Create a mask: valid if the output angle is within the input's FOV.
-    valid_mask = (np.abs(theta) <= half_input_fov) & (np.abs(phi) <= half_input_fov)
+    valid_mask = (np.abs(phi) <= half_input_fov)[:, np.newaxis] & (np.abs(theta) <= half_input_fov)[np.newaxis, :]
     
     # For valid pixels, compute the corresponding input coordinates.
     # (These equations invert the pinhole projection: theta = arctan((u-cx)/f))
-    map_x = f_x * np.tan(theta) + cx
-    map_y = f_y * np.tan(phi) + cy
-    
     # For invalid pixels (outside the input FOV), assign dummy values.
     # We'll set them to -1 so that cv2.remap (with BORDER_CONSTANT) returns black.
-    map_x[~valid_mask] = -1
-    map_y[~valid_mask] = -1
+    map_x = np.where(valid_mask, (f_x * np.tan(theta) + cx)[np.newaxis, :], -1).astype(np.float32)
+    map_y = np.where(valid_mask, (f_y * np.tan(phi) + cy)[:, np.newaxis], -1).astype(np.float32)
     
-    # Convert mapping arrays to float32 (required by cv2.remap).
-    map_x = map_x.astype(np.float32)
-    map_y = map_y.astype(np.float32)
+    # Convert to the fixed point format, halves the map size and saves cv2.remap from converting the maps on every call.
+    map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    
+    return map1, map2
+
+def convert_to_equirectangular(image, input_fov=100):
+    """
+    Maps an input rectilinear image rendered at a limited FOV (e.g., 100°)
+    into a 180° equirectangular image while keeping the output size the same as the input.
+    The valid image (representing the central 100°) is centered,
+    with black padding on the sides and top/bottom.
+    
+    Parameters:
+      image: Input image (H x W x 3, np.uint8)
+      input_fov: Field of view (in degrees) of the input image. Default is 100.
+      
+    Returns:
+      A new image (np.uint8) of the same shape as input, representing a 180° equirectangular projection.
+    """
+    # Get image dimensions.
+    H, W = image.shape[:2]
+    map1, map2 = _build_equirect_maps(H, W, input_fov)
     
     # Remap the image. Pixels with mapping -1 will be filled with borderValue.
-    equirect_img = cv2.remap(image, map_x, map_y, interpolation=cv2.INTER_LINEAR,
+    equirect_img = cv2.remap(image, map1, map2, interpolation=cv2.INTER_LINEAR,
                              borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0))
     
     return equirect_img
 
+def decode_depth(bgr, max_depth):
+    """
+    Decodes a rgb encoded depth frame, as read by cv2 (BGR channel order), into metric depth (H x W, np.float32).
+    The high byte of the 16 bit depth value is stored as the mean of the R and G channels and the low byte in B.
+    """
+    # Pack the two bytes into a uint16 and scale it once
+    depth16 = (bgr[..., 2].astype(np.uint16) + bgr[..., 1]) >> 1
+    depth16 <<= 8
+    depth16 |= bgr[..., 0]
+    
+    # Same scale as the old uint32 decode where the 16 bits sat in the top two bytes: value * 2**16 / (255**4 / max_depth)
+    depth = depth16.astype(np.float32)
+    depth *= 65536 * max_depth / 255**4
+    return depth
+
+#Touchly uses reverse depth, the inversion is done with a byte lookup table
+_touchly_lut = (255 - np.arange(256)).astype(np.uint8)
+_touchly_lut_unrendered_far = _touchly_lut.copy()
+_touchly_lut_unrendered_far[0] = 0
+
+def encode_touchly_depth(depth, max_depth, unrendered_is_far = False, out = None):
+    """
+    Encodes metric depth as the reversed 8 bit depth touchly uses, repeated over 3 channels (H x W x 3, np.uint8).
+    If unrendered_is_far is set pixels at zero depth (ie. the render background) are moved to the back instead of the front.
+    If out is given the result is written into it instead of a new array.
+    """
+    # Scales, rounds and saturates (ie. clips at max_depth) to 8 bit in one pass
+    depth8bit = cv2.convertScaleAbs(depth, alpha=255/max_depth)
+    depth8bit = cv2.LUT(depth8bit, _touchly_lut_unrendered_far if unrendered_is_far else _touchly_lut)
+    
+    if out is None:
+        out = np.empty(depth8bit.shape + (3,), dtype=np.uint8)
+    np.copyto(out, depth8bit[..., np.newaxis]) # broadcast to the 3 channels without a temporary
+    return out
+
+def touchly1_frame(color_image, depth, max_depth, unrendered_is_far = False):
+    """
+    Builds a touchly1 frame with the color image on top of the encoded depth.
+    The depth is encoded straight into the bottom half of the frame instead of being concatenated.
+    """
+    h = color_image.shape[0]
+    frame = np.empty((h*2,) + color_image.shape[1:], dtype=np.uint8)
+    frame[:h] = color_image
+    encode_touchly_depth(depth, max_depth, unrendered_is_far, out = frame[h:])
+    return frame
+
+class AsyncVideoWriter:
+    """
+    Wraps a video writer (cv2.VideoWriter or ffmpegcv) so that frames are encoded on a background thread
+    while the next frame is being rendered. write() only queues the frame so it must not be modified afterwards.
+    """
+    def __init__(self, writer, queue_size = 4):
+        self.writer = writer
+        self._error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            if self._error is None: #Keep emptying the queue after a failure so write() cant block forever
+                try:
+                    self.writer.write(frame)
+                except Exception as e:
+                    self._error = e
+
+    def write(self, frame):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(frame)
+
+    def release(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.release()
+        if self._error is not None:
+            raise self._error
+
+class FramePrefetcher:
+    """
+    Runs a frame generator on a background thread so that reading and decoding the next frames
+    overlaps with the rendering of the current one. Iterate over it like the generator and call close() when done.
+    """
+    _end = object()
+
+    def __init__(self, frames, queue_size = 2):
+        self._error = None
+        self._stop = threading.Event()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._fill, args=(frames,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fill(self, frames):
+        try:
+            for item in frames:
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._error = e
+        self._put(self._end)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._end:
+                if self._error is not None:
+                    raise self._error
+                return
+            yield item
+
+    def close(self):
+        """Stops the reader thread, needs to be called before the videos are released."""
+        self._stop.set()
+        self._thread.join()
+
+def read_frames(raw_video, color_video, mask_video, max_depth):
+    """
+    Yields (color_frame, depth, mask_img) for every frame in the depth video.
+    color_frame is the color video frame (or the depth video frame if there is no color video) in BGR order,
+    depth the decoded metric depth and mask_img the grayscale mask frame or None if there is no mask video.
+    """
+    while raw_video.isOpened():
+        ret, raw_frame = raw_video.read()
+        if not ret:
+            break
+        
+        # Everything is kept in the BGR order cv2 reads and writes, the mesh colors are only used as labels
+        # so the renders come out in BGR as well and no color conversion is needed.
+        color_frame = None
+        if color_video is not None:
+            ret, color_frame = color_video.read()
+            
+            assert color_frame.shape == raw_frame.shape, "color image and depth image need to have same width and height" #potential BUG here with mono depth videos
+        else:
+            color_frame = raw_frame
+        
+        mask_img = None
+        if mask_video is not None:
+            ret, mask_frame = mask_video.read()
+            if ret:
+                mask_img = cv2.cvtColor(mask_frame, cv2.COLOR_BGR2GRAY)
+        
+        # Decode video depth
+        depth = decode_depth(raw_frame, max_depth)
+        
+        yield color_frame, depth, mask_img
+
+class PointAccumulator:
+    """
+    Growable storage for the compound background points and their colors.
+    To keep the memory use down on long videos the points are stored as int16 in steps of resolution meters
+    and the colors as uint8, 9 bytes per point instead of 48. The resolution is 3mm (a range of +-98m) unless
+    max_extent, the largest coordinate in meters that will be stored, needs coarser steps to fit in int16.
+    New points are copied into preallocated arrays that double in size when full, so
+    accumulating points over a long video does not reallocate the whole cloud every frame.
+    """
+    def __init__(self, max_extent = 0.0, resolution = 0.003):
+        self.size = 0
+        self.resolution = max(resolution, max_extent / np.iinfo(np.int16).max)
+        self._clip_warned = False
+        self._points = np.empty((0, 3), dtype=np.int16)
+        self._colors = np.empty((0, 3), dtype=np.uint8)
+
+    @property
+    def points(self):
+        """The points in meters (N x 3, np.float64)"""
+        return self._points[:self.size] * self.resolution
+
+    @property
+    def colors(self):
+        """The colors in the 0-1 range (N x 3, np.float64)"""
+        return self._colors[:self.size] / 255.0
+
+    def append(self, points, colors):
+        new_size = self.size + len(points)
+        if new_size > len(self._points):
+            capacity = max(new_size, 2*len(self._points), 4096)
+            for name in ('_points', '_colors'):
+                old = getattr(self, name)
+                grown = np.empty((capacity, 3), dtype=old.dtype)
+                grown[:self.size] = old[:self.size]
+                setattr(self, name, grown)
+        
+        quantized = np.rint(np.asarray(points) / self.resolution)
+        limit = np.iinfo(np.int16).max
+        if not self._clip_warned and len(quantized) and np.abs(quantized).max() > limit:
+            print(f"Warning: background points further than {limit*self.resolution:.1f}m from the origin are clamped and will be stored in the wrong place")
+            self._clip_warned = True
+        np.clip(quantized, -limit-1, limit, out=quantized)
+        self._points[self.size:new_size] = quantized
+        self._colors[self.size:new_size] = np.rint(np.asarray(colors) * 255)
+        self.size = new_size
+
+    def replace(self, points, colors):
+        """Replaces the content (keeping the allocated capacity), used after down sampling."""
+        self.size = 0
+        self.append(points, colors)
+
 
 if __name__ == '__main__':
     
@@ -111,6 +336,8 @@ if __name__ == '__main__':
     parser.add_argument('--mask_video', type=str, help='video file to use as mask input to filter out the forground and generate a background version of the mesh that can be used as infill. Requires non moving camera or very good tracking.', required=False)
     parser.add_argument('--save_background', action='store_true', help='Save the compound background as a file. To be ussed as infill.', required=False)
     parser.add_argument('--load_background', help='Load the compound background as a file. To be used as infill.', required=False)
+    parser.add_argument('--nvcodec', action='store_true', help='Decode the color video and encode --compressed output on a NVIDIA GPU (NVDEC/NVENC). Requires ffmpegcv.', required=False)
+    parser.add_argument('--cuda_render', action='store_true', help='Render the stereo views on the GPU with nvdiffrast instead of Open3D. Requires torch and nvdiffrast. Not used for --mask_video background renders or --touchly1.', required=False)
     
     
     args = parser.parse_args()
@@ -131,7 +358,12 @@ if __name__ == '__main__':
     if args.color_video is not None:
         if not os.path.isfile(args.color_video):
             raise Exception("input color_video does not exist")
-        color_video = cv2.VideoCapture(args.color_video)
+        if args.nvcodec:
+            # The depth video is lossless FFV1 which NVDEC cant decode, so only the color video is GPU decoded
+            import ffmpegcv
+            color_video = ffmpegcv.VideoCaptureNV(args.color_video)
+        else:
+            color_video = cv2.VideoCapture(args.color_video)
         
     mask_video = None
     if args.mask_video is not None:
@@ -139,18 +371,27 @@ if __name__ == '__main__':
             raise Exception("input mask_video does not exist")
         mask_video = cv2.VideoCapture(args.mask_video)
     
+    # The background from --mask_video is a point cloud and touchly1 needs a single view, both are rendered by Open3D
+    render_stereo = depth_map_tools.render_stereo
+    if args.cuda_render and mask_video is None and not args.touchly1:
+        import torch
+        import nvdiffrast.torch
+        if not torch.cuda.is_available():
+            raise Exception("--cuda_render requires a CUDA capable GPU and a CUDA build of torch")
+        # The mesh triangles stay the same between frames unless edges are removed, so they only have to be uploaded once
+        render_stereo = functools.partial(depth_map_tools.render_stereo_cuda, triangles_changed = (args.infill_mask | args.remove_edges))
+    
     transformations = None
     if args.transformation_file is not None:
         if not os.path.isfile(args.transformation_file):
             raise Exception("input transformation_file does not exist")
         with open(args.transformation_file) as json_file_handle:
-            transformations = json.load(json_file_handle)
+            transformations = np.array(json.load(json_file_handle), dtype=np.float64) # (N, 4, 4)
     
         if args.transformation_lock_frame != 0:
             ref_frame = transformations[args.transformation_lock_frame]
             ref_frame_inv_trans = np.linalg.inv(ref_frame)
-            for i, transformation in enumerate(transformations):
-                transformations[i] = transformation @ ref_frame_inv_trans
+            transformations = transformations @ ref_frame_inv_trans # one batched matmul over all frames
         
     raw_video = cv2.VideoCapture(args.depth_video)
     frame_width, frame_height = int(raw_video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(raw_video.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -194,64 +435,59 @@ if __name__ == '__main__':
         output_file += "mkv"
         codec = cv2.VideoWriter_fourcc(*"FFV1")
     
-    out = cv2.VideoWriter(output_file, codec, frame_rate, out_size)
+    if args.compressed and args.nvcodec:
+        import ffmpegcv
+        out = ffmpegcv.VideoWriterNV(output_file, 'h264', frame_rate)
+    else:
+        out = cv2.VideoWriter(output_file, codec, frame_rate, out_size)
+    out = AsyncVideoWriter(out)
     
     infill_mask_video = None
     if args.infill_mask:
-        infill_mask_video = cv2.VideoWriter(output_file+"_infillmask.mkv", cv2.VideoWriter_fourcc(*"FFV1"), frame_rate, out_size)
+        infill_mask_video = AsyncVideoWriter(cv2.VideoWriter(output_file+"_infillmask.mkv", cv2.VideoWriter_fourcc(*"FFV1"), frame_rate, out_size))
     
     if mask_video is not None:
         # Create background "sphere"
         bg_cloud = o3d.geometry.PointCloud()
-        bg_points = np.asarray(bg_cloud.points)
-        bg_point_colors = np.asarray(bg_cloud.colors)
+        # Size the storage to the largest coordinate that can show up: the furthest depth along the widest pixel ray, plus any scene translation
+        max_ray_length = np.sqrt((frame_width/2/cam_matrix[0][0])**2 + (frame_height/2/cam_matrix[1][1])**2 + 1)
+        max_extent = MODEL_maxOUTPUT_depth * max_ray_length
+        if transformations is not None:
+            max_extent += np.linalg.norm(transformations[:, :3, 3], axis=1).max()
         
+        loaded_bg = None
         if args.load_background:
             loaded_bg = np.load(args.load_background)
-            bg_points = loaded_bg[0]
-            bg_point_colors = loaded_bg[1]
+            if len(loaded_bg[0]):
+                max_extent = max(max_extent, np.abs(loaded_bg[0]).max())
+        
+        bg_store = PointAccumulator(max_extent)
+        if loaded_bg is not None:
+            bg_store.append(loaded_bg[0], loaded_bg[1][:, ::-1]) #stored as RGB, we work in BGR
     
     
-    left_shift = -(args.pupillary_distance/1000)/2
-    right_shift = +(args.pupillary_distance/1000)/2
+    eye_baseline = args.pupillary_distance/1000
 
     frame_n = 0
     last_mesh = None
-    while raw_video.isOpened():
+    
+    # The touchly0 depth is remapped to equirectangular before it is written so its buffer can be reused every frame
+    touchly_left_depth_buffer = None
+    if args.touchly0:
+        touchly_left_depth_buffer = np.empty((out_height, out_width, 3), dtype=np.uint8)
+    
+    # Frames are read and decoded on a background thread while the current frame is rendered
+    frames = FramePrefetcher(read_frames(raw_video, color_video, mask_video, MODEL_maxOUTPUT_depth))
+    for color_frame, depth, mask_img in frames:
         
         print(f"Frame: {frame_n} {frame_n/frame_rate}s")
         frame_n += 1
-        ret, raw_frame = raw_video.read()
-        if not ret:
-            break
-        
-        rgb = cv2.cvtColor(raw_frame, cv2.COLOR_BGR2RGB)
-        
-        color_frame = None
-        if color_video is not None:
-            ret, color_frame = color_video.read()
-            color_frame = cv2.cvtColor(color_frame, cv2.COLOR_BGR2RGB)
-            
-            assert color_frame.shape == rgb.shape, "color image and depth image need to have same width and height" #potential BUG here with mono depth videos
-        else:
-            color_frame = rgb
-
-        # Decode video depth
-        depth = np.zeros((frame_height, frame_width), dtype=np.uint32)
-        depth_unit = depth.view(np.uint8).reshape((frame_height, frame_width, 4))
-        depth_unit[..., 3] = ((rgb[..., 0].astype(np.uint32) + rgb[..., 1]).astype(np.uint32) / 2)
-        depth_unit[..., 2] = rgb[..., 2]
-        depth = depth.astype(np.float32)/((255**4)/MODEL_maxOUTPUT_depth)
-        
         
         if transformations is None and args.touchly1: #Fast path we can skip the full render pass
-            depth8bit = np.rint(np.minimum(depth, args.touchly_max_depth)*(255/args.touchly_max_depth)).astype(np.uint8)
-            touchly_depth = np.repeat(depth8bit[..., np.newaxis], 3, axis=-1)
-            touchly_depth = 255 - touchly_depth #Touchly uses reverse depth
-            out_image = cv2.vconcat([color_frame, touchly_depth])
+            out_image = touchly1_frame(color_frame, depth, args.touchly_max_depth)
         else:
             
-            bg_color = np.array([0.0, 0.0, 0.0])
+            bg_color = np.array([0.0, 0.0, 0.0]) # BGR
             if infill_mask_video is not None:
                 bg_color = np.array([0.0, 1.0, 0.0])
                 bg_color_infill_detect = np.array([0, 255, 0], dtype=np.uint8)
@@ -259,7 +495,7 @@ if __name__ == '__main__':
             
             
             if transformations is not None:
-                transform_to_zero = np.array(transformations[frame_n-1])
+                transform_to_zero = transformations[frame_n-1]
             else:
                 transform_to_zero = np.eye(4)
                 
@@ -272,35 +508,31 @@ if __name__ == '__main__':
             
             if mask_video is not None:
                 
-                ret, mask_frame = mask_video.read()
-                mask_img = np.array(cv2.cvtColor(mask_frame, cv2.COLOR_BGR2GRAY))
-                
                 #find all black pixels 
                 mask_img1d = mask_img.reshape(-1)
-                bg_mask = np.where(mask_img1d < 128)[0]
                 
-                # intersect the mask pixels with the pizels that are not edges
-                points_2_keep = np.intersect1d(used_indices, bg_mask)
+                # intersect the mask pixels with the pizels that are not edges (both are masks over the same pixel grid so a AND is enough)
+                points_2_keep = np.zeros(mask_img1d.shape[0], dtype=bool)
+                points_2_keep[used_indices] = True
+                points_2_keep &= mask_img1d < 128
                 
                 new_points = np.asarray(mesh.vertices)[points_2_keep]
                 new_colors = np.asarray(mesh.vertex_colors)[points_2_keep]
                 
                 
-                bg_points  = np.concatenate((bg_points, new_points), axis=0)
-                bg_point_colors  = np.concatenate((bg_point_colors, new_colors), axis=0)
-                
-                bg_cloud = depth_map_tools.pts_2_pcd(bg_points, bg_point_colors)
+                bg_store.append(new_points, new_colors)
                 
                 #clear up the point clouds every so often
                 if frame_n % 10 == 0:
                     print("clearing up pointcloud")
                     
                     # perspective_aware_down_sample makes sense when you are looking in the same direction, techically a normal down_sample function would be better. But it is to slow.
+                    bg_cloud = depth_map_tools.pts_2_pcd(bg_store.points, bg_store.colors)
                     bg_cloud = depth_map_tools.perspective_aware_down_sample(bg_cloud, 0.003)#1 cubic cm
                 
-                    bg_points  = np.asarray(bg_cloud.points)
-                    bg_point_colors = np.asarray(bg_cloud.colors)
-                    bg_cloud = copy.deepcopy(bg_cloud)
+                    bg_store.replace(np.asarray(bg_cloud.points), np.asarray(bg_cloud.colors))
+                elif not args.save_background: #the cloud is only needed for rendering
+                    bg_cloud = depth_map_tools.pts_2_pcd(bg_store.points, bg_store.colors)
                     
                 
                 
@@ -320,63 +552,45 @@ if __name__ == '__main__':
                 color_transformed = (color_transformed*255).astype(np.uint8)
                 
                 
-                touchly_depth8bit = np.rint(np.minimum(touchly_depth, args.touchly_max_depth)*(255/args.touchly_max_depth)).astype(np.uint8)
-                touchly_depth8bit[touchly_depth8bit == 0] = 255 # Any pixel at zero depth needs to move back as it is part of the render viewport background and not the mesh
-                touchly_depth8bit = 255 - touchly_depth8bit #Touchly uses reverse depth
-                touchly_depth = np.repeat(touchly_depth8bit[..., np.newaxis], 3, axis=-1)
-                
-                out_image = cv2.vconcat([color_transformed, touchly_depth])
+                # Any pixel at zero depth needs to move back as it is part of the render viewport background and not the mesh
+                out_image = touchly1_frame(color_transformed, touchly_depth, args.touchly_max_depth, unrendered_is_far = True)
                 
                 if infill_mask_video is not None:
-                    bg_mask = np.all(color_transformed == bg_color_infill_detect, axis=-1)
-                    img_mask = np.zeros((frame_height, frame_width), dtype=np.uint8)
-                    img_mask[bg_mask] = 255
+                    img_mask = cv2.inRange(color_transformed, bg_color_infill_detect, bg_color_infill_detect)
                     
                     zero = np.zeros((frame_height, frame_width), dtype=np.uint8)
                     
                     out_mask_image = cv2.vconcat([img_mask, zero])
-                    infill_mask_video.write(cv2.cvtColor(out_mask_image, cv2.COLOR_RGB2BGR))
+                    infill_mask_video.write(cv2.cvtColor(out_mask_image, cv2.COLOR_GRAY2BGR))
                     
             else:
             
-                #move mesh for left eye render
-                mesh.translate([-left_shift, 0.0, 0.0])
-                left_image = (depth_map_tools.render([mesh], render_cam_matrix, bg_color = bg_color)*255).astype(np.uint8)
+                #Render both eyes in one pass, touchly0 also requires a left eye depthmap
+                if args.touchly0:
+                    left_image, right_image, left_depth = render_stereo([mesh], render_cam_matrix, eye_baseline, depth = True, bg_color = bg_color)
+                else:
+                    left_image, right_image = render_stereo([mesh], render_cam_matrix, eye_baseline, bg_color = bg_color)
+                left_image = (left_image*255).astype(np.uint8)
+                right_image = (right_image*255).astype(np.uint8)
                 
                 if infill_mask_video is not None:
-                    bg_mask = np.all(left_image == bg_color_infill_detect, axis=-1)
-                    left_img_mask = np.zeros((frame_height, frame_width), dtype=np.uint8)
-                    left_img_mask[bg_mask] = 255
+                    left_img_mask = cv2.inRange(left_image, bg_color_infill_detect, bg_color_infill_detect)
                     
             
                 touchly_left_depth = None
-                #Touchly1 requires a left eye depthmap XXX use dual rendering here to speed things upp
                 if args.touchly0:
-                    left_depth = depth_map_tools.render([mesh], render_cam_matrix, True)
-                    left_depth8bit = np.rint(np.minimum(left_depth, args.touchly_max_depth)*(255/args.touchly_max_depth)).astype(np.uint8)
-                    left_depth8bit[left_depth8bit == 0] = 255 # Any pixel at zero depth needs to move back is is non rendered depth buffer(ie things on the side of the mesh)
-                    left_depth8bit = 255 - left_depth8bit #Touchly uses reverse depth
-                    touchly_left_depth = np.repeat(left_depth8bit[..., np.newaxis], 3, axis=-1)
-            
-                #Move mesh back to center
-                mesh.translate([left_shift, 0.0, 0.0])
-        
-                #move mesh for right eye render
-                mesh.translate([-right_shift, 0.0, 0.0])
-                right_image = (depth_map_tools.render([mesh], render_cam_matrix, bg_color = bg_color)*255).astype(np.uint8)
+                    # Any pixel at zero depth needs to move back is is non rendered depth buffer(ie things on the side of the mesh)
+                    touchly_left_depth = encode_touchly_depth(left_depth, args.touchly_max_depth, unrendered_is_far = True, out = touchly_left_depth_buffer)
                 
                 if infill_mask_video is not None:
-                    bg_mask = np.all(right_image == bg_color_infill_detect, axis=-1)
-                    right_img_mask = np.zeros((frame_height, frame_width), dtype=np.uint8)
-                    right_img_mask[bg_mask] = 255
+                    right_img_mask = cv2.inRange(right_image, bg_color_infill_detect, bg_color_infill_detect)
             
                 imgs = [left_image, right_image]
                 if touchly_left_depth is not None:
                     imgs.append(touchly_left_depth)
                 
                 if args.vr180:
-                    for i, img in enumerate(imgs):
-                        imgs[i] = convert_to_equirectangular(img, input_fov = render_fov)
+                    imgs = list(_remap_pool.map(lambda img: convert_to_equirectangular(img, input_fov = render_fov), imgs))
             
                 out_image = cv2.hconcat(imgs)
                 
@@ -388,17 +602,18 @@ if __name__ == '__main__':
                         imgs.append(zero)
             
                     out_mask_image = cv2.hconcat(imgs)
-                    infill_mask_video.write(cv2.cvtColor(out_mask_image, cv2.COLOR_RGB2BGR))
+                    infill_mask_video.write(cv2.cvtColor(out_mask_image, cv2.COLOR_GRAY2BGR))
         
         
-        out.write(cv2.cvtColor(out_image, cv2.COLOR_RGB2BGR))
+        out.write(out_image)
         
         if args.max_frames < frame_n and args.max_frames != -1:
             break
         
     if args.save_background:
-        np.save(args.depth_video + '_background.npy', np.array([bg_points, bg_point_colors]))
+        np.save(args.depth_video + '_background.npy', np.array([bg_store.points, bg_store.colors[:, ::-1]]))
     
+    frames.close()
     raw_video.release()
     out.release()
     